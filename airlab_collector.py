@@ -2,17 +2,32 @@
 """AirLab MQTT Data Logger with SQLite storage."""
 
 import argparse
-import json
+import functools
 import logging
 import os
+import signal
 import sqlite3
 import sys
+import threading
 import time
+from collections.abc import Iterable
 from pathlib import Path
 
 import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
 
+# Prefer a C JSON parser when installed (`uv sync --extra fast`); all three
+# raise a ValueError subclass on malformed input.
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        import json as _json
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+
 # AirLab MQTT topic suffixes → DB column names
 # Topics: airlab/co2, airlab/tmp, airlab/hum, airlab/prs, airlab/voc, airlab/nox
 FIELD_ALIASES: dict[str, str] = {
@@ -23,6 +38,8 @@ FIELD_ALIASES: dict[str, str] = {
     "voc": "voc_index",
     "nox": "nox_index",
 }
+# JSON payloads may already use column names as keys
+_CANON_SET = frozenset(FIELD_ALIASES.values())
 
 VALID_RANGES = {
     "co2_ppm": (150, 10000),
@@ -33,12 +50,27 @@ VALID_RANGES = {
     "nox_index": (0, 500),
 }
 
+# Insert column order; row tuples are built in this order for positional binds
+_COLS = (
+    "co2_ppm",
+    "temperature_c",
+    "humidity_percent",
+    "pressure_hpa",
+    "voc_index",
+    "nox_index",
+)
+_INSERT_SQL = (
+    f"INSERT INTO airlab_readings ({', '.join(_COLS)}) "
+    f"VALUES ({', '.join('?' * len(_COLS))})"
+)
+_BOUNDS = {col: VALID_RANGES[col] for col in _COLS}
+
 logger = logging.getLogger("airlab_collector")
 
 
-def setup_logging() -> None:
+def setup_logging(verbose: bool = False) -> None:
     logging.basicConfig(
-        level=logging.INFO,
+        level=logging.DEBUG if verbose else logging.INFO,
         format="%(asctime)s %(levelname)s %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
         stream=sys.stdout,
@@ -46,27 +78,41 @@ def setup_logging() -> None:
 
 
 def load_config() -> dict:
-    script_dir = Path(__file__).resolve().parent
-    load_dotenv(script_dir / ".env")
+    load_dotenv(SCRIPT_DIR / ".env")
+    db_path = os.getenv("DB_PATH", str(SCRIPT_DIR / "airlab.db")).strip()
     return {
         "host": os.getenv("MQTT_HOST", "localhost").strip(),
         "port": int(os.getenv("MQTT_PORT", "1883")),
         "username": os.getenv("MQTT_USERNAME", "").strip(),
         "password": os.getenv("MQTT_PASSWORD", "").strip(),
         "base_topic": os.getenv("MQTT_BASE_TOPIC", "airlab").strip(),
-        "db_path": os.getenv(
-            "DB_PATH", str(script_dir / "airlab.db")
-        ).strip(),
+        "db_path": db_path,
+        # Optional small "hot" DB for writes; rows are moved into db_path
+        # by --archive so readers of db_path never wait on the collector.
+        "db_write_path": os.getenv("DB_WRITE_PATH", "").strip() or db_path,
     }
 
 
 def init_db(db_path: str) -> sqlite3.Connection:
     Path(db_path).parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(db_path, timeout=10)
+    # Autocommit mode: the writer path manages its own transactions.
+    # timeout sets SQLite's busy timeout: it waits up to 30 s for a writer
+    # lock itself (about what the old 3x retry/backoff loop tolerated).
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    # WAL lets Grafana read while we write; NORMAL skips the per-commit fsync
+    # (safe under WAL).
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    # Checkpoint every ~1000 pages and truncate the -wal file back to 64 MB
+    # afterwards, so it can't grow unbounded on the Pi's SD card.
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    conn.execute("PRAGMA journal_size_limit=67108864")
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS airlab_readings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER PRIMARY KEY,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
             co2_ppm REAL,
             temperature_c REAL,
@@ -81,29 +127,35 @@ def init_db(db_path: str) -> sqlite3.Connection:
         "CREATE INDEX IF NOT EXISTS idx_airlab_timestamp "
         "ON airlab_readings(timestamp)"
     )
-    conn.commit()
     return conn
 
 
+@functools.lru_cache(maxsize=256)
 def canonicalize(field: str) -> str | None:
     return FIELD_ALIASES.get(field.lower().strip())
 
 
 def try_float(value) -> float | None:
+    # JSON numbers arrive already parsed; only text needs float() and its
+    # ValueError path.
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, (str, bytes)):
+        return None
     try:
         return float(value)
-    except (ValueError, TypeError):
+    except ValueError:
         return None
 
 
-def parse_json_payload(payload: str) -> dict[str, float]:
+def parse_json_payload(payload: str | bytes) -> dict[str, float]:
     """Parse a JSON object into canonical {column: value} pairs."""
-    data = json.loads(payload)
+    data = _json.loads(payload)
     if not isinstance(data, dict):
         return {}
     reading: dict[str, float] = {}
     for key, value in data.items():
-        canon = canonicalize(key)
+        canon = key if key in _CANON_SET else canonicalize(key)
         if canon:
             v = try_float(value)
             if v is not None:
@@ -112,70 +164,109 @@ def parse_json_payload(payload: str) -> dict[str, float]:
 
 
 def parse_topic_value(
-    topic: str, payload: str, base_topic: str
+    topic: str, payload: str, base_prefix: str
 ) -> dict[str, float]:
-    """Parse a single-value-per-topic message (e.g. airlab/co2 -> 800)."""
-    relative = topic
-    if topic.startswith(base_topic):
-        relative = topic[len(base_topic) :].strip("/")
-    for part in reversed(relative.split("/")):
-        canon = canonicalize(part)
-        if canon:
-            v = try_float(payload)
-            if v is not None:
-                return {canon: v}
-    return {}
+    """Parse a single-value-per-topic message (e.g. airlab/co2 -> 800).
+
+    ``base_prefix`` is the base topic with a trailing slash (``airlab/``).
+    """
+    head, _, leaf = topic.rpartition("/")
+    canon = canonicalize(leaf)
+    if not canon:
+        # Field name isn't the last segment; scan the rest right to left.
+        relative = head
+        if f"{head}/".startswith(base_prefix):
+            relative = head[len(base_prefix) :]
+        for part in reversed(relative.split("/")):
+            canon = canonicalize(part)
+            if canon:
+                break
+        else:
+            return {}
+    v = try_float(payload)
+    if v is None:
+        return {}
+    return {canon: v}
 
 
 def validate_reading(reading: dict[str, float]) -> bool:
+    # Keys come from canonicalize(), so every one has bounds in _BOUNDS.
     for key, value in reading.items():
-        bounds = VALID_RANGES.get(key)
-        if bounds and not (bounds[0] <= value <= bounds[1]):
+        lo, hi = _BOUNDS[key]
+        if not (lo <= value <= hi):
             logger.warning(
                 "Validation failed: %s=%s (expected %s-%s)",
                 key,
                 value,
-                bounds[0],
-                bounds[1],
+                lo,
+                hi,
             )
             return False
     return True
 
 
-def insert_reading(conn: sqlite3.Connection, reading: dict[str, float]) -> None:
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            conn.execute(
-                """
-                INSERT INTO airlab_readings
-                    (co2_ppm, temperature_c, humidity_percent,
-                     pressure_hpa, voc_index, nox_index)
-                VALUES
-                    (:co2_ppm, :temperature_c, :humidity_percent,
-                     :pressure_hpa, :voc_index, :nox_index)
-                """,
-                {
-                    "co2_ppm": reading.get("co2_ppm"),
-                    "temperature_c": reading.get("temperature_c"),
-                    "humidity_percent": reading.get("humidity_percent"),
-                    "pressure_hpa": reading.get("pressure_hpa"),
-                    "voc_index": reading.get("voc_index"),
-                    "nox_index": reading.get("nox_index"),
-                },
-            )
-            conn.commit()
-            return
-        except sqlite3.OperationalError as exc:
-            if "database is locked" in str(exc) and attempt < max_retries - 1:
-                logger.warning(
-                    "Database locked, retrying (%d/%d)",
-                    attempt + 1,
-                    max_retries,
-                )
-                time.sleep(0.5 * (attempt + 1))
-            else:
-                raise
+def insert_reading(
+    conn: sqlite3.Connection, readings: Iterable[dict[str, float]]
+) -> None:
+    """Insert readings in one transaction (one commit per batch, not per row)."""
+    rows = [tuple(reading.get(c) for c in _COLS) for reading in readings]
+    if not rows:
+        return
+    # IMMEDIATE takes the write lock up front rather than upgrading from a
+    # shared lock mid-transaction, which can fail with SQLITE_BUSY.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(_INSERT_SQL, rows)
+        conn.execute("COMMIT")
+    except BaseException:
+        # A failed COMMIT leaves the transaction open in autocommit mode
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def save_reading(conn: sqlite3.Connection, reading: dict[str, float]) -> None:
+    """Validate a merged reading and insert it if it passes."""
+    if validate_reading(reading):
+        insert_reading(conn, [reading])
+        logger.info(
+            "Saved: %s",
+            "  ".join(f"{k}={v}" for k, v in sorted(reading.items())),
+        )
+    else:
+        logger.warning("Reading failed validation, not saved")
+
+
+def sensor_subscriptions(base_prefix: str, qos: int = 0) -> list[tuple[str, int]]:
+    """Topics to subscribe to under ``base_prefix`` (e.g. ``airlab/``)."""
+    # Only the sensor leaves (plus a JSON "state" blob), so the broker drops
+    # HA discovery /config and unrelated siblings (usb, chg, ...) for us.
+    topics = [f"{base_prefix}{leaf}" for leaf in FIELD_ALIASES]
+    topics.append(f"{base_prefix}state")
+    return [(topic, qos) for topic in topics]
+
+
+def parse_message(msg: mqtt.MQTTMessage, base_prefix: str) -> dict[str, float]:
+    """Parse an MQTT message into canonical {column: value} pairs."""
+    topic = msg.topic
+
+    # Skip HA discovery config messages and anything outside our base
+    # topic before touching the (possibly multi-KB) payload
+    if topic.endswith("/config") or not topic.startswith(base_prefix):
+        return {}
+
+    # Try JSON object first, straight from the raw bytes
+    parsed: dict[str, float] = {}
+    try:
+        parsed = parse_json_payload(msg.payload)
+    except ValueError:
+        pass
+
+    # Fall back to single-value-per-topic; only now decode to text
+    if not parsed:
+        payload = msg.payload.decode("utf-8", errors="replace").strip()
+        parsed = parse_topic_value(topic, payload, base_prefix)
+    return parsed
 
 
 # ── Single-shot MQTT read ─────────────────────────────────────────────────────
@@ -184,44 +275,29 @@ def insert_reading(conn: sqlite3.Connection, reading: dict[str, float]) -> None:
 def read_airlab(cfg: dict, timeout: int = 30) -> dict[str, float] | None:
     """Connect to MQTT, collect one reading, disconnect."""
     base_topic = cfg["base_topic"]
-    subscribe_topic = f"{base_topic}/#"
+    base_prefix = f"{base_topic}/"
+    subscriptions = sensor_subscriptions(base_prefix)
     reading: dict[str, float] = {}
-    got_data = False
-    first_msg_time: list[float] = []  # mutable container for closure
+    first_msg_time: float | None = None
 
     def on_connect(client, userdata, flags, reason_code, properties=None):
         if reason_code == 0:
-            logger.info("Connected to MQTT broker, subscribing to %s", subscribe_topic)
-            client.subscribe(subscribe_topic)
+            logger.info(
+                "Connected to MQTT broker, subscribing to %s",
+                ", ".join(t for t, _ in subscriptions),
+            )
+            client.subscribe(subscriptions)
         else:
             logger.error("MQTT connection failed: %s", reason_code)
 
     def on_message(client, userdata, msg: mqtt.MQTTMessage):
-        nonlocal got_data
-        payload = msg.payload.decode("utf-8", errors="replace").strip()
-        topic = msg.topic
-
-        # Skip HA discovery config messages
-        if topic.endswith("/config"):
-            return
-
-        # Try JSON object first
-        parsed: dict[str, float] = {}
-        try:
-            parsed = parse_json_payload(payload)
-        except (json.JSONDecodeError, ValueError):
-            pass
-
-        # Fall back to single-value-per-topic
-        if not parsed:
-            parsed = parse_topic_value(topic, payload, base_topic)
-
+        nonlocal first_msg_time
+        parsed = parse_message(msg, base_prefix)
         if parsed:
             reading.update(parsed)
-            got_data = True
-            if not first_msg_time:
-                first_msg_time.append(time.monotonic())
-            logger.info("Received: %s", parsed)
+            if first_msg_time is None:
+                first_msg_time = time.monotonic()
+            logger.debug("Received: %s", parsed)
 
     client = mqtt.Client(
         mqtt.CallbackAPIVersion.VERSION2,
@@ -240,23 +316,28 @@ def read_airlab(cfg: dict, timeout: int = 30) -> dict[str, float] | None:
         logger.error("Could not connect to MQTT broker: %s", e)
         return None
 
-    # Poll until we have data or timeout
-    client.loop_start()
+    # Drive the network loop on this thread; loop() blocks in select() so we
+    # wake as soon as a message arrives rather than on a fixed poll interval.
     deadline = time.monotonic() + timeout
     collect_window = 3  # seconds after first message to collect more values
 
-    while time.monotonic() < deadline:
-        time.sleep(0.5)
-        # If we got data, wait a bit more for additional topic messages
-        if first_msg_time:
-            elapsed_since_first = time.monotonic() - first_msg_time[0]
-            if elapsed_since_first >= collect_window:
-                break
+    while True:
+        end = deadline
+        if first_msg_time is not None:
+            # If we got data, wait a bit more for additional topic messages
+            end = min(deadline, first_msg_time + collect_window)
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        # Cap each wait so loop() regularly gets to send keepalive PINGREQs
+        rc = client.loop(timeout=min(remaining, 1.0))
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            logger.error("MQTT connection lost: %s", mqtt.error_string(rc))
+            break
 
-    client.loop_stop()
     client.disconnect()
 
-    if not got_data:
+    if first_msg_time is None:
         logger.error("No data received within %ds", timeout)
         return None
 
@@ -265,7 +346,7 @@ def read_airlab(cfg: dict, timeout: int = 30) -> dict[str, float] | None:
 
 def single_reading(cfg: dict, timeout: int = 30) -> None:
     """Take a single reading and exit (for cron)."""
-    conn = init_db(cfg["db_path"])
+    conn = init_db(cfg["db_write_path"])
     try:
         reading = read_airlab(cfg, timeout=timeout)
         if reading is None:
@@ -276,25 +357,178 @@ def single_reading(cfg: dict, timeout: int = 30) -> None:
             logger.error("Empty reading from AirLab")
             sys.exit(1)
 
-        if validate_reading(reading):
-            insert_reading(conn, reading)
+        save_reading(conn, reading)
+    finally:
+        try:
+            conn.execute("PRAGMA optimize")
+        except sqlite3.Error as e:
+            logger.warning("PRAGMA optimize failed: %s", e)
+        finally:
+            conn.close()
+
+
+# ── Daemon mode ───────────────────────────────────────────────────────────────
+
+
+def daemon_loop(cfg: dict, interval: int = 60) -> None:
+    """Keep one MQTT session open and save a merged reading every interval."""
+    base_prefix = f"{cfg['base_topic']}/"
+    # Persistent session + QoS 1 subscriptions. The broker only queues values
+    # while we're offline if the AirLab publishes at QoS >= 1 (delivery uses
+    # the lower of the two). Queued values replay on reconnect and are merged
+    # into the current row; newer values for the same field overwrite them.
+    subscriptions = sensor_subscriptions(base_prefix, qos=1)
+    conn = init_db(cfg["db_write_path"])
+    # Filled by the network thread, drained by the main thread every interval
+    reading: dict[str, float] = {}
+    reading_lock = threading.Lock()
+    stop = threading.Event()
+
+    def save_pending() -> None:
+        with reading_lock:
+            pending = dict(reading)
+            reading.clear()
+        if not pending:
+            return
+        try:
+            save_reading(conn, pending)
+        except sqlite3.Error as e:
+            # e.g. still locked after the busy timeout (--archive running);
+            # keep the values for the next interval and stay connected
+            logger.error("Could not save reading: %s", e)
+            with reading_lock:
+                for key, value in pending.items():
+                    reading.setdefault(key, value)
+
+    def on_connect(client, userdata, flags, reason_code, properties=None):
+        if reason_code == 0:
             logger.info(
-                "Saved: %s",
-                "  ".join(f"{k}={v}" for k, v in sorted(reading.items())),
+                "Connected to MQTT broker (session present: %s), subscribing to %s",
+                flags.session_present,
+                ", ".join(t for t, _ in subscriptions),
             )
+            client.subscribe(subscriptions)
         else:
-            logger.warning("Reading failed validation, not saved")
+            logger.error("MQTT connection failed: %s", reason_code)
+
+    def on_message(client, userdata, msg: mqtt.MQTTMessage):
+        parsed = parse_message(msg, base_prefix)
+        if parsed:
+            with reading_lock:
+                reading.update(parsed)
+            logger.debug("Received: %s", parsed)
+
+    # Stable client_id so the broker can resume the session after a restart;
+    # single-shot runs use a per-pid id and never take it over.
+    client = mqtt.Client(
+        mqtt.CallbackAPIVersion.VERSION2,
+        client_id="airlab-collector",
+        clean_session=False,
+    )
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.reconnect_delay_set(min_delay=1, max_delay=60)
+
+    if cfg["username"]:
+        client.username_pw_set(cfg["username"], cfg["password"])
+
+    logger.info("Connecting to %s:%s ...", cfg["host"], cfg["port"])
+    try:
+        client.connect(cfg["host"], cfg["port"], keepalive=60)
+    except Exception as e:
+        logger.error("Could not connect to MQTT broker: %s", e)
+        conn.close()
+        sys.exit(1)
+
+    def handle_signal(sig, frame):
+        logger.info("Shutting down")
+        stop.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    # The network thread reconnects on its own; the main thread owns the
+    # SQLite connection and saves one row per interval (the latest value of
+    # each field), whether or not new messages keep arriving.
+    client.loop_start()
+    try:
+        while not stop.wait(interval):
+            save_pending()
+    finally:
+        client.disconnect()
+        client.loop_stop()
+        try:
+            save_pending()
+            conn.execute("PRAGMA optimize")
+        except sqlite3.Error as e:
+            logger.warning("PRAGMA optimize failed: %s", e)
+        finally:
+            conn.close()
+
+
+# ── Archiving ─────────────────────────────────────────────────────────────────
+
+
+def archive_readings(cfg: dict, older_than_hours: int) -> int:
+    """Move rows older than N hours from DB_WRITE_PATH into DB_PATH."""
+    if cfg["db_write_path"] == cfg["db_path"]:
+        logger.warning("DB_WRITE_PATH is not set, nothing to archive")
+        return 0
+
+    init_db(cfg["db_write_path"]).close()  # make sure the hot table exists
+    conn = init_db(cfg["db_path"])
+    cols = ", ".join(_COLS)
+    same_row = " AND ".join(
+        ["m.timestamp = l.timestamp"] + [f"m.{c} IS l.{c}" for c in _COLS]
+    )
+    try:
+        conn.execute("ATTACH DATABASE ? AS live", (cfg["db_write_path"],))
+        (cutoff,) = conn.execute(
+            "SELECT datetime('now', ?)", (f"-{older_than_hours} hours",)
+        ).fetchone()
+        # Under WAL a commit is only atomic per file, so copy and delete are
+        # separate transactions: the copy skips rows already in DB_PATH, and
+        # rows leave the hot file only after the copy has committed. A crash
+        # in between is repaired by the next run, never duplicated or lost.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            copied = conn.execute(
+                f"INSERT INTO main.airlab_readings (timestamp, {cols}) "
+                f"SELECT timestamp, {cols} FROM live.airlab_readings AS l "
+                "WHERE l.timestamp < ? AND NOT EXISTS "
+                f"(SELECT 1 FROM main.airlab_readings AS m WHERE {same_row})",
+                (cutoff,),
+            ).rowcount
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            moved = conn.execute(
+                "DELETE FROM live.airlab_readings WHERE timestamp < ?",
+                (cutoff,),
+            ).rowcount
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
     finally:
         conn.close()
 
+    logger.info(
+        "Archived %d readings older than %s (%d copied)", moved, cutoff, copied
+    )
+    return moved
+
 
 # ── Entry point ───────────────────────────────────────────────────────────────
 
 
 def main() -> None:
-    setup_logging()
-    cfg = load_config()
-
     parser = argparse.ArgumentParser(description="AirLab MQTT Data Logger")
     parser.add_argument(
         "--single",
@@ -305,15 +539,41 @@ def main() -> None:
         "--timeout",
         type=int,
         default=30,
-        help="MQTT wait timeout in seconds (default 30)",
+        help="MQTT wait timeout in seconds for --single (default 30)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=60,
+        help="Seconds between saved readings in daemon mode (default 60)",
+    )
+    parser.add_argument(
+        "--archive",
+        type=int,
+        metavar="HOURS",
+        help="Move readings older than HOURS from DB_WRITE_PATH into DB_PATH and exit",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Log every received MQTT value",
     )
     args = parser.parse_args()
+    if args.archive is not None and args.archive < 0:
+        parser.error("--archive HOURS must be 0 or greater")
+    if args.interval < 1:
+        parser.error("--interval must be at least 1 second")
 
-    if args.single:
+    setup_logging(verbose=args.verbose)
+    cfg = load_config()
+
+    if args.archive is not None:
+        archive_readings(cfg, args.archive)
+    elif args.single:
         single_reading(cfg, timeout=args.timeout)
     else:
-        # Default: also single mode (no daemon)
-        single_reading(cfg, timeout=args.timeout)
+        daemon_loop(cfg, interval=args.interval)
 
 
 if __name__ == "__main__":
@@ -19,10 +19,19 @@ from pathlib import Path
 import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
 
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        _json = json
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+
 
 def load_config() -> dict:
-    script_dir = Path(__file__).resolve().parent
-    load_dotenv(script_dir / ".env")
+    load_dotenv(SCRIPT_DIR / ".env")
     return {
         "host": os.getenv("MQTT_HOST", "localhost").strip(),
         "port": int(os.getenv("MQTT_PORT", "1883")),
@@ -43,13 +52,11 @@ def on_connect(client, userdata, flags, reason_code, properties=None):
 
 def on_message(client, userdata, msg: mqtt.MQTTMessage):
     now = datetime.now(timezone.utc).strftime("%H:%M:%S")
-    payload = msg.payload.decode("utf-8", errors="replace")
 
     try:
-        data = json.loads(payload)
-        payload = json.dumps(data, indent=2)
-    except (json.JSONDecodeError, ValueError):
-        pass
+        payload = json.dumps(_json.loads(msg.payload), indent=2)
+    except ValueError:
+        payload = msg.payload.decode("utf-8", errors="replace")
 
     print(f"\n[{now}] Topic: {msg.topic}")
     print(f"  Payload: {payload}")